@@ -8,6 +8,7 @@ import os
 import glob
 import time
 import datetime
+import functools
 import astropy.io
 import numpy as np
 from astropy.table import Table
@@ -421,6 +422,13 @@ def decode_camword(camword):
     Returns (np.ndarray, 1d):  an array containing strings of                                                              
                                 cameras, e.g. 'b0','r1',...                                                                
     """
+    return list(_decode_camword(camword))
+
+@functools.lru_cache(maxsize=128)
+def _decode_camword(camword):
+    """
+    Cached implementation of decode_camword, returning an immutable tuple
+    """
     log = get_logger()
     searchstr = camword
     camlist = []
@@ -439,7 +447,64 @@ def decode_camword(camword):
                 log.error(f"Couldn't understand key={key} in camword={camword}.")
                 raise ValueError(f"Couldn't understand key={key} in camword={camword}.")
             searchstr = searchstr[1:]
-    return sorted(camlist)
+    return tuple(sorted(camlist))
+
+@functools.lru_cache(maxsize=128)
+def _parse_camera_string(cameras):
+    """
+    Cached camword conversion of a cleaned (stripped, lower case) cameras
+    string for parse_cameras
+    """
+    log = get_logger()
+    ## Check to see if it already has cameras names specified
+    if 'a' in cameras or 'b' in cameras or 'r' in cameras or 'z' in cameras:
+        ## If there is a comma, treat each substring
+        ## else decode and re-encode the camword to get the simplest camword represention
+        if ',' in cameras:
+            camlist = []
+            ## Treat each substring as it's own substring
+            for substr in cameras.split(','):
+                ## If len 1 and numeric, its a spectrograph name
+                if len(substr) == 1 and substr.isnumeric():
+                    camlist.append('b' + substr)
+                    camlist.append('r' + substr)
+                    camlist.append('z' + substr)
+                ## If larger than 2 chars and has letters, it's a camword. Decode it
+                elif len(substr) > 2 and substr[0] in ['a','b','r','z']:
+                    camlist.extend(decode_camword(substr))
+                ## If larger than 2 chars and no letters, it's a list of spectrographs
+                elif len(substr) > 2 and substr[0].isnumeric():
+                    for char in substr:
+                        if char.isnumeric():
+                            camlist.append('b' + char)
+                            camlist.append('r' + char)
+                            camlist.append('z' + char)
+                ## If len 2 and starts with a, it's the full spectrograph
+                elif 'a' == substr[0]:
+                    camlist.append('b'+substr[1])
+                    camlist.append('r'+substr[1])
+                    camlist.append('z'+substr[1])
+                ## else add the one camera if it is a known camera
+                elif substr[0] in ['b','r','z']:
+                    camlist.append(substr)
+                ## otherwise throw a message
+                else:
+                    log.error(f"Couldn't understand substring={substr}.")
+                    raise ValueError(f"Couldn't understand substring={substr}.")
+
+            ## Encode the given list of spectrographs to the simplest camword form
+            camword = create_camword(camlist)
+        else:
+            ## decode and re-encode the camword to get the simplest camword represention
+            camword = create_camword(decode_camword(cameras))
+    ## if no letters present, then assume the comma separated list is of spectrographs
+    elif ',' in cameras:
+        camword = 'a'+cameras.replace(',','')
+    ## if no letters or commas present, then assume the string is of spectrographs without commas
+    else:
+        camword = 'a'+cameras
+
+    return camword
 
 def parse_cameras(cameras):
     """
@@ -463,53 +528,7 @@ def parse_cameras(cameras):
     elif type(cameras) is str:
         ## Clean the string
         cameras = cameras.strip(' \t').lower()
-        ## Check to see if it already has cameras names specified
-        if 'a' in cameras or 'b' in cameras or 'r' in cameras or 'z' in cameras:
-            ## If there is a comma, treat each substring
-            ## else decode and re-encode the camword to get the simplest camword represention
-            if ',' in cameras:
-                camlist = []
-                ## Treat each substring as it's own substring
-                for substr in cameras.split(','):
-                    ## If len 1 and numeric, its a spectrograph name
-                    if len(substr) == 1 and substr.isnumeric():
-                        camlist.append('b' + substr)
-                        camlist.append('r' + substr)
-                        camlist.append('z' + substr)
-                    ## If larger than 2 chars and has letters, it's a camword. Decode it
-                    elif len(substr) > 2 and substr[0] in ['a','b','r','z']:
-                        camlist.extend(decode_camword(substr))
-                    ## If larger than 2 chars and no letters, it's a list of spectrographs
-                    elif len(substr) > 2 and substr[0].isnumeric():
-                        for char in substr:
-                            if char.isnumeric():
-                                camlist.append('b' + char)
-                                camlist.append('r' + char)
-                                camlist.append('z' + char)
-                    ## If len 2 and starts with a, it's the full spectrograph
-                    elif 'a' == substr[0]:
-                        camlist.append('b'+substr[1])
-                        camlist.append('r'+substr[1])
-                        camlist.append('z'+substr[1])
-                    ## else add the one camera if it is a known camera
-                    elif substr[0] in ['b','r','z']:
-                        camlist.append(substr)
-                    ## otherwise throw a message
-                    else:
-                        log.error(f"Couldn't understand substring={substr}.")
-                        raise ValueError(f"Couldn't understand substring={substr}.")
-
-                ## Encode the given list of spectrographs to the simplest camword form
-                camword = create_camword(camlist)
-            else:
-                ## decode and re-encode the camword to get the simplest camword represention
-                camword = create_camword(decode_camword(cameras))
-        ## if no letters present, then assume the comma separated list is of spectrographs
-        elif ',' in cameras:
-            camword = 'a'+cameras.replace(',','')
-        ## if no letters or commas present, then assume the string is of spectrographs without commas
-        else:
-            camword = 'a'+cameras
+        camword = _parse_camera_string(cameras)
     ## If it is a list or array, treat it as a camlist to encode
     elif not np.isscalar(cameras):
         camword = create_camword(cameras)
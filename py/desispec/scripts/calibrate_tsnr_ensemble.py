@@ -7,15 +7,14 @@ import os
 import sys
 import argparse
 import numpy as np
+import fitsio
 from pkg_resources import resource_filename
 
 import astropy.io.fits as fits
-from astropy.table import Table, join
-
-import matplotlib.pyplot as plt
+from astropy.table import Table
 
 from desiutil.log import get_logger
-from desispec.tsnr import template_ensemble
+from desispec.tsnr import template_ensemble, write_ensemble_hdulist
 from desimodel.io import load_desiparams
 from desimodel.fastfiberacceptance import FastFiberAcceptance
 
@@ -42,7 +41,33 @@ def parse(options=None):
 
     return args
 
-def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=True, exclude=None, use_sv1=False):
+def read_table_columns(filename, columns):
+    '''
+    Read only the given columns (those which exist) of the first table
+    of a FITS file or of an ASCII (e.g. csv) table.
+    '''
+    #- identify FITS files by content rather than by extension (.fit, .fits.fz, ...)
+    try:
+        fx = fitsio.FITS(filename)
+    except OSError:
+        fx = None
+
+    if fx is not None:
+        with fx:
+            hdu = next((hdu for hdu in fx if hdu.get_exttype() in ('BINARY_TBL', 'ASCII_TBL')), None)
+            if hdu is None:
+                log = get_logger()
+                msg = 'No table HDU in {}'.format(filename)
+                log.critical(msg)
+                raise ValueError(msg)
+            colnames = hdu.get_colnames()
+            table = Table(hdu.read(columns=[c for c in columns if c in colnames]))
+        table.convert_bytestring_to_unicode()
+        return table
+
+    return Table.read(filename, include_names=columns)
+
+def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=False, exclude=None, use_sv1=False):
     '''
     Given an external calibration, e.g.
     /global/cfs/cdirs/desi/survey/observations/SV1/sv1-exposures.fits
@@ -60,7 +85,9 @@ def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=Tru
 
     tsnr_col  = 'TSNR2_{}'.format(tracer.upper())
 
-    ext_calib = Table.read(exposures_table_filename)
+    ext_calib = read_table_columns(exposures_table_filename,
+                                   ['EXPID', 'EXPTIME', 'TARGETS', 'GOALTYPE', 'EFFTIME_BRIGHT', 'BGS_EFFTIME_BRIGHT',
+                                    'EFFTIME_DARK', 'ELG_EFFTIME_DARK', tsnr_col])
 
     # Quality cuts.
     ext_calib = ext_calib[(ext_calib['EXPTIME'] > 0.)]
@@ -94,9 +121,11 @@ def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=Tru
             ext_calib = ext_calib[ext_calib['GOALTYPE']=='dark']
 
     else:
-        log.critical('External calibration for tracer {} is not defined.'.format(tracer))
+        msg = 'External calibration for tracer {} is not defined.'.format(tracer)
+        log.critical(msg)
+        raise ValueError(msg)
 
-    tsnr_run  = Table.read(tsnr_table_filename)
+    tsnr_run  = read_table_columns(tsnr_table_filename, ['EXPID', tsnr_col])
 
     # TSNR == 0.0 if exposure was not successfully reduced.
     tsnr_run  = tsnr_run[tsnr_run[tsnr_col] > 0.0]
@@ -109,21 +138,20 @@ def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=Tru
 
     tsnr_run  = tsnr_run[~np.isin(tsnr_run['EXPID'], exclude)]
 
-    # Keep common exposures.
-    ref_extexpids = ext_calib['EXPID']
+    # Keep common exposures, with rows of both tables matched and sorted by (unique) EXPID.
+    nref = len(ext_calib)
 
-    ext_calib = ext_calib[np.isin(ext_calib['EXPID'], tsnr_run['EXPID'])]
-    tsnr_run  = tsnr_run[np.isin(tsnr_run['EXPID'], ext_calib['EXPID'])]
+    _, iext, itsnr = np.intersect1d(ext_calib['EXPID'], tsnr_run['EXPID'], assume_unique=True, return_indices=True)
+    ext_calib = ext_calib[iext]
+    tsnr_run  = tsnr_run[itsnr]
 
-    ref_frac  = np.mean(np.isin(ref_extexpids, ext_calib['EXPID']))
+    ref_frac  = len(ext_calib) / nref if nref > 0 else 0.
 
     log.info('Found {:.6f} of ref. exposures in provided tsnr'.format(ref_frac))
 
     if ref_frac < 0.7:
         log.critical('Provided TSNR is likely missing exposures required to calibrate (!)')
 
-    e2i={e:i for i,e in enumerate(ext_calib['EXPID'])}
-    ii=[e2i[e] for e in tsnr_run["EXPID"]]
     efftime_col_ref=efftime_col+"_REF"
     tsnr_run[efftime_col_ref] = ext_calib[efftime_col]
 
@@ -151,6 +179,8 @@ def tsnr_efftime(exposures_table_filename, tsnr_table_filename, tracer, plot=Tru
         slope_tsnr2    = 1.
 
     if plot:
+        import matplotlib.pyplot as plt
+
         plt.figure("efftime-vs-tsnr2-{}".format(tracer))
         plt.plot(tsnr_run[tsnr_col], tsnr_run[efftime_col_ref], c='k', marker='.', lw=0.0, markersize=1)
         plt.plot(tsnr_run[tsnr_col], slope_efftime*tsnr_run[tsnr_col], c='k', lw=0.5)
@@ -228,7 +258,7 @@ def main(args):
         hdr['SNR2TIME'] = ( slope_efftime_calib , "eff. time factor")
         hdr['TIMEFILE']    = os.path.basename(effective_time_calibration_table_filename)
         hdr['TSNRFILE']    = os.path.basename(args.tsnr_table_filename)
-        ens.writeto(args.outfile, overwrite=True)
+        write_ensemble_hdulist(ens, args.outfile)
         log.info("wrote {}".format(args.outfile))
     else :
         log.info('fitted slope efftime vs tsnr2 = {:.6f}'.format(slope_efftime))
@@ -8,12 +8,10 @@ import sys
 import yaml
 import desiutil
 import fitsio
-import desisim
 import argparse
 import os.path                       as     path
 import numpy                         as     np
 import astropy.io.fits               as     fits
-import matplotlib.pyplot             as     plt
 
 from   desiutil                      import depend
 from   astropy.convolution           import convolve, Box1DKernel
@@ -21,19 +19,12 @@ from   pathlib                       import Path
 from   desiutil.dust                 import mwdust_transmission
 from   desiutil.log                  import get_logger
 from   pkg_resources                 import resource_filename
-from   scipy.interpolate             import interp1d
 from   astropy.table                 import Table, join
 
-from desispec.tsnr import template_ensemble, gfa_template_ensemble
+from desispec.tsnr import template_ensemble, gfa_template_ensemble, ensemble_filename
 
 np.random.seed(seed=314)
 
-# AR/DK DESI spectra wavelengths
-# TODO:  where are brz extraction wavelengths defined?  https://github.com/desihub/desispec/issues/1006.
-wmin, wmax, wdelta = 3600, 9824, 0.8
-wave               = np.round(np.arange(wmin, wmax + wdelta, wdelta), 1)
-cslice             = {"b": slice(0, 2751), "r": slice(2700, 5026), "z": slice(4900, 7781)}
-
 def parse(options=None):
     parser = argparse.ArgumentParser(description="Generate a sim. template ensemble stack of given type and write it to disk at --outdir.")
     parser.add_argument('--nmodel', type = int, default = 1000, required=False,
@@ -52,6 +43,8 @@ def parse(options=None):
 			help='Dont convolve each template dF^2 with redshift distribution')
     parser.add_argument('--mag-range', action='store_true',
 			help='Monte Carlo the full mag range (given in config file) instead of using the same effective mag for all templates')
+    parser.add_argument('--cache-dir', type = str, default = None, required=False,
+			help='directory where generated templates are cached for reruns (default is no caching)')
     args = None
 
     if options is None:
@@ -71,9 +64,9 @@ def main(args):
     elif args.tracer in ['bgs', 'lrg', 'elg', 'lya', 'qso']:
         templates = template_ensemble(tracer=args.tracer,config_filename=args.config_filename)
         templates.compute(nmodel=args.nmodel, smooth=args.smooth, nz_table_filename=args.nz_filename,
-                      convolve_to_nz=(not args.no_nz_convolution), single_mag=(not args.mag_range))
-        filename = "{}/tsnr-ensemble-{}.fits".format(args.outdir,args.tracer)
-        templates.write(filename)
+                      convolve_to_nz=(not args.no_nz_convolution), single_mag=(not args.mag_range),
+                      cache_dir=args.cache_dir)
+        templates.write(ensemble_filename(args.outdir, args.tracer))
     else:
         raise ValueError('Unknown tracer {} to compute.'.format(args.tracer))
 
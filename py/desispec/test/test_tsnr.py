@@ -0,0 +1,99 @@
+"""
+Test desispec.tsnr
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from astropy.table import Table
+from astropy.convolution import convolve, Box1DKernel
+
+from desispec.tsnr import WAVE, read_template_cache, write_template_cache, template_ensemble, smooth_residuals
+
+try:
+    import desisim.templates
+    desisim_available = 'DESI_BASIS_TEMPLATES' in os.environ
+except ImportError:
+    desisim_available = False
+
+class TestSmoothResiduals(unittest.TestCase):
+
+    def test_box_residuals(self):
+        """Test smooth_residuals against astropy Box1DKernel for odd and even widths"""
+        rng = np.random.default_rng(0)
+        flux = rng.normal(size=(3, 1000))
+        for width in (1, 2, 3, 4, 5, 10, 99, 100, 125, 1000, 1200):
+            dflux = smooth_residuals(flux, width)
+            for i in range(flux.shape[0]):
+                expected = flux[i] - convolve(flux[i], Box1DKernel(width), boundary='extend')
+                self.assertTrue(np.allclose(dflux[i], expected, rtol=0, atol=1e-10), f'width={width}')
+
+        #- single precision input stays single precision
+        dflux = smooth_residuals(flux.astype(np.float32), 100)
+        self.assertEqual(dflux.dtype, np.float32)
+        expected = flux - np.array([convolve(row, Box1DKernel(100), boundary='extend') for row in flux])
+        self.assertTrue(np.allclose(dflux, expected, rtol=0, atol=1e-5))
+
+class TestTemplateCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.isdir(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_cache_roundtrip(self):
+        """Test that cached templates are read back unchanged"""
+        nmodel = 4
+        rng = np.random.default_rng(1)
+        flux = rng.normal(size=(nmodel, WAVE.size)).astype(np.float32)
+        meta = Table()
+        meta['TARGETID'] = np.arange(nmodel)
+        meta['REDSHIFT'] = rng.uniform(0.1, 0.5, nmodel).astype(np.float32)
+        meta['TEMPLATETYPE'] = ['BGS',] * nmodel
+        objmeta = Table()
+        objmeta['TARGETID'] = np.arange(nmodel)
+        objmeta['VDISP'] = rng.uniform(50, 200, nmodel)
+
+        filename = os.path.join(self.testdir, 'cache', 'tsnr-templates-bgs-test.npz')
+        write_template_cache(filename, WAVE, flux, meta, objmeta)
+        self.assertEqual(os.listdir(os.path.dirname(filename)), [os.path.basename(filename)])
+
+        wave2, flux2, meta2, objmeta2 = read_template_cache(filename)
+        self.assertTrue(np.all(wave2 == WAVE))
+        self.assertEqual(flux2.dtype, flux.dtype)
+        self.assertTrue(np.all(flux2 == flux))
+        for orig, cached in ((meta, meta2), (objmeta, objmeta2)):
+            self.assertEqual(orig.colnames, cached.colnames)
+            for col in orig.colnames:
+                self.assertTrue(np.all(orig[col] == cached[col]), col)
+
+    @unittest.skipUnless(desisim_available, "desisim or $DESI_BASIS_TEMPLATES not available; skipping template generation test.")
+    def test_generate_templates_cache(self):
+        """Test that a cache hit returns the same templates as the cache miss"""
+        cache_dir = os.path.join(self.testdir, 'generate')
+        ens = template_ensemble('bgs')
+        wave1, flux1, meta1, objmeta1 = ens.generate_templates(nmodel=3, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        wave2, flux2, meta2, objmeta2 = ens.generate_templates(nmodel=3, cache_dir=cache_dir)
+        self.assertTrue(np.all(wave1 == wave2))
+        self.assertTrue(np.all(flux1 == flux2))
+        for orig, cached in ((meta1, meta2), (objmeta1, objmeta2)):
+            self.assertEqual(orig.colnames, cached.colnames)
+            for col in orig.colnames:
+                self.assertTrue(np.all(orig[col] == cached[col]), col)
+
+        #- no cache dir means no caching
+        wave3, flux3, meta3, objmeta3 = ens.generate_templates(nmodel=3)
+        self.assertTrue(np.all(flux1 == flux3))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,25 +1,30 @@
+import io
 import os
 import numpy as np
 import time
 import desispec
 
+import fitsio
+import numba
 import astropy.io.fits as fits
 from astropy.table import Table
-from astropy.convolution import convolve, Box1DKernel
 
 import json
 import glob
 import yaml
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pkg_resources import resource_filename
 
 from scipy.optimize import minimize
-from scipy.interpolate import RectBivariateSpline,interp1d
+from scipy.interpolate import RectBivariateSpline
 from scipy.signal import fftconvolve
 from desiutil.log import get_logger
 from desiutil.dust import dust_transmission
 
 from desispec.io import findfile,read_frame,read_fiberflat,read_sky,read_flux_calibration,iotime,read_xytraceset
 from desispec.io.spectra import Spectra
+from desispec.io.util import get_tempfilename
 from desispec.calibfinder import findcalibfile
 from astropy import constants as const
 from desimodel.io import load_desiparams
@@ -27,6 +32,16 @@ from desimodel.io import load_platescale
 from desimodel.fastfiberacceptance import FastFiberAcceptance
 from desispec.fiberfluxcorr import flat_to_psf_flux_correction
 
+# AR/DK DESI spectra wavelengths, shared by the template ensembles
+# TODO:  where are brz extraction wavelengths defined?  https://github.com/desihub/desispec/issues/1006.
+WMIN, WMAX, WDELTA = 3600, 9824, 0.8
+WAVE   = np.round(np.arange(WMIN, WMAX + WDELTA, WDELTA), 1)
+# wavelength range [A] of each band, and corresponding slices of WAVE
+# (b: 0-2751, r: 2700-5026, z: 4900-7781)
+BAND_EDGES = {"b": (3600., 5800.), "r": (5760., 7620.), "z": (7520., 9824.)}
+CSLICE = {band: slice(int(np.searchsorted(WAVE, wmin)), int(np.searchsorted(WAVE, wmax, side='right')))
+          for band, (wmin, wmax) in BAND_EDGES.items()}
+
 class Config(object):
     def __init__(self, cpath):
         with open(cpath) as f:
@@ -35,6 +50,25 @@ class Config(object):
         for key in d:
             setattr(self, key, d[key])
 
+def ensemble_filename(dirname, tracer):
+    '''
+    Returns the path of the TSNR ensemble file of tracer in directory dirname
+    '''
+    return os.path.join(dirname, 'tsnr-ensemble-{}.fits'.format(tracer))
+
+def write_ensemble_hdulist(hdulist, filename):
+    '''
+    Writes the astropy HDUList of an ensemble to filename, serialized in memory
+    and written in one go rather than HDU per HDU, to a temporary file that is
+    renamed to filename once complete
+    '''
+    buf = io.BytesIO()
+    hdulist.writeto(buf)
+    tmpfile = get_tempfilename(filename)
+    with open(tmpfile, 'wb') as fx:
+        fx.write(buf.getvalue())
+    os.rename(tmpfile, filename)
+
 class gfa_template_ensemble(object):
     '''
     '''
@@ -51,13 +85,13 @@ class gfa_template_ensemble(object):
 
         # passband: wave [3000., 11000.]
         self.pb = Table.read(self.pb_fname, names=['wave', 'trans'])
-        self.pb_interp = interp1d(self.pb['wave'], self.pb['trans'], kind='linear', copy=True, bounds_error=False, fill_value=0.0, assume_sorted=False)
+        self.pb.sort('wave')
 
-        self.wmin = 3600
-        self.wmax = 9824
-        self.wdelta = 0.8
-        self.wave = np.round(np.arange(self.wmin, self.wmax + self.wdelta, self.wdelta), 1)
-        self.cslice = {"b": slice(0, 2751), "r": slice(2700, 5026), "z": slice(4900, 7781)}
+        self.wmin = WMIN
+        self.wmax = WMAX
+        self.wdelta = WDELTA
+        self.wave = WAVE
+        self.cslice = dict(CSLICE)
 
     def compute(self):
         log = get_logger()
@@ -66,7 +100,7 @@ class gfa_template_ensemble(object):
 
         for band in ['b', 'r', 'z']:
             band_wave = self.wave[self.cslice[band]]
-            self.ensemble_dflux[band] = self.pb_interp(band_wave).reshape(1, len(band_wave))
+            self.ensemble_dflux[band] = np.interp(band_wave, self.pb['wave'], self.pb['trans'], left=0., right=0.)[None, :]
 
         log.info('GPB passband TSNR template computation done.')
 
@@ -96,13 +130,80 @@ class gfa_template_ensemble(object):
                 hdu_list.append(fits.ImageHDU(self.wave[self.cslice[band]], name='WAVE_{}'.format(band.upper())))
                 hdu_list.append(fits.ImageHDU(self.ensemble_dflux[band], name='DFLUX_{}'.format(band.upper())))
 
-            hdu_list = fits.HDUList(hdu_list)
-            hdu_list.writeto(dirname + '/tsnr-ensemble-{}.fits'.format(tracer), overwrite=True)
+            filename = ensemble_filename(dirname, tracer)
 
-            log.info('Successfully written GFA TSNR template to ' + dirname + '/tsnr-ensemble-{}.fits'.format(tracer))
+            write_ensemble_hdulist(fits.HDUList(hdu_list), filename)
+
+            log.info('Successfully written GFA TSNR template to ' + filename)
 
         log.info('Should now be copied to $DESIMODEL/data/tsnr/.')
 
+def write_template_cache(filename, wave, flux, meta, objmeta):
+    '''
+    Writes generated templates wave, flux, meta and objmeta tables to the
+    cache file filename (.npz), creating its directory if needed
+    '''
+    dirname = os.path.dirname(filename)
+    if dirname != '' :
+        os.makedirs(dirname, exist_ok=True)
+    tmpfile = get_tempfilename(filename)
+    np.savez(tmpfile, wave=wave, flux=flux, meta=meta.as_array(), objmeta=objmeta.as_array())
+    os.rename(tmpfile, filename)
+
+def read_template_cache(filename):
+    '''
+    Returns wave, flux, meta, objmeta from a template cache file written by write_template_cache
+    '''
+    with np.load(filename) as cache :
+        return cache['wave'], cache['flux'], Table(cache['meta']), Table(cache['objmeta'])
+
+#- desisim.templates class, config attributes of the magnitude range and
+#- whether the templates are normalized to fiber magnitudes, for each tracer.
+#- Cuts from https://github.com/desihub/desitarget/blob/dd353c6c8dd8b8737e45771ab903ac30584db6db/py/desitarget/cuts.py
+#- (L1312 BGS, L517 ELG, L1422 QSO on mag.; L447 LRG on fib. mag. with
+#- desisim.templates setting FIBERFLUX to FLUX)
+TRACER_TEMPLATES = {
+    'bgs': ('BGS', ('med_mag', 'limit_mag'), False),
+    'lrg': ('LRG', ('med_fibmag', 'limit_fibmag'), True),
+    'elg': ('ELG', ('med_mag', 'limit_mag'), False),
+    'qso': ('QSO', ('med_mag', 'limit_mag'), False),
+}
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def numba_box_residuals(flux, width) :
+    '''
+    Returns the residuals dflux = flux - box(flux) of each row of the 2D array flux,
+    where box is the convolution with astropy.convolution.Box1DKernel(width), extending
+    the edge values beyond the boundaries (boundary='extend').
+
+    As for Box1DKernel, an even width is a centered window of width+1 pixels with
+    half weights on its two end pixels.
+
+    Uses a running sum so the cost does not depend on width; rows are processed in parallel.
+    '''
+    nrow, ncol = flux.shape
+    dflux  = np.empty_like(flux)
+    half   = width // 2
+    edge   = 0.5 if width % 2 == 0 else 0.
+    for i in numba.prange(nrow) :
+        s = 0.
+        for k in range(-half, half + 1) :
+            s += flux[i, min(max(k, 0), ncol - 1)]
+        for j in range(ncol) :
+            lo = flux[i, max(j - half, 0)]
+            hi = flux[i, min(j + half, ncol - 1)]
+            dflux[i, j] = flux[i, j] - (s - edge * (lo + hi)) / width
+            s += flux[i, min(j + half + 1, ncol - 1)] - lo
+    return dflux
+
+def smooth_residuals(flux, smoothing):
+    '''
+    Returns the residuals dflux = flux - smooth(flux) of each row of the 2D array flux,
+    where smooth is the convolution with astropy.convolution.Box1DKernel(smoothing),
+    extending the edge values beyond the boundaries.
+    '''
+    return numba_box_residuals(np.ascontiguousarray(flux), int(smoothing))
+
 class template_ensemble(object):
     '''
     Generate an ensemble of templates to sample tSNR for a range of points in
@@ -120,13 +221,11 @@ class template_ensemble(object):
 
         self.tracer = tracer.lower()  # support ELG or elg, etc.
 
-        # AR/DK DESI spectra wavelengths
-        # TODO:  where are brz extraction wavelengths defined?  https://github.com/desihub/desispec/issues/1006.
-        self.wmin = 3600
-        self.wmax = 9824
-        self.wdelta = 0.8
-        self.wave               = np.round(np.arange(self.wmin, self.wmax + self.wdelta, self.wdelta), 1)
-        self.cslice             = {"b": slice(0, 2751), "r": slice(2700, 5026), "z": slice(4900, 7781)}
+        self.wmin = WMIN
+        self.wmax = WMAX
+        self.wdelta = WDELTA
+        self.wave = WAVE
+        self.cslice = dict(CSLICE)
 
         if config_filename is None :
             config_filename = resource_filename('desispec', 'data/tsnr/tsnr-config-{}.yaml'.format(self.tracer))
@@ -142,8 +241,25 @@ class template_ensemble(object):
         """
         return -0.5*2.5*np.log10( (10**(-0.8*m1)-10**(-0.8*m2))/(0.8*np.log(10.))/(m2-m1) )
 
+    def template_cache_filename(self, cache_dir, nmodel, redshifts=None, mags=None, single_mag=True) :
+        """
+        returns the path of the cached templates in cache_dir, keyed by a hash
+        of the tracer, nmodel, input redshifts and mags, config, wavelength grid,
+        seed and desisim version
+        """
+        import desisim
+
+        key = hashlib.sha1(repr((self.tracer, nmodel, single_mag, self.seed, sorted(self.config.__dict__.items()),
+                                 self.wmin, self.wmax, self.wdelta, desisim.__version__)).encode())
+        for values in (redshifts, mags) :
+            if values is not None :
+                key.update(np.ascontiguousarray(values, dtype=float).tobytes())
+        key = key.hexdigest()[:16]
+
+        return os.path.join(cache_dir, 'tsnr-templates-{}-{}.npz'.format(self.tracer, key))
+
     def generate_templates(self, nmodel, redshifts=None,
-                           mags=None,single_mag=True):
+                           mags=None,single_mag=True, cache_dir=None):
         '''
             Dedicated wrapper for desisim.templates.GALAXY.make_templates call,
             stipulating templates in a redshift range suggested by the FDR.
@@ -154,6 +270,11 @@ class template_ensemble(object):
             tracer [bgs, lrg, elg, qso], having generated nmodel templates.
             Optionally, provide redshifts and mags. to condition appropriately
             at cost of runtime.
+
+            If cache_dir is set, the templates are read from (or saved to)
+            a cache file in cache_dir to skip their generation on reruns.
+            The cache is keyed by the desisim version, not by the basis
+            templates files, so clear it if those change.
         '''
             # Only import desisim if code is run, not at module import
         # to minimize desispec -> desisim -> desispec dependency loop
@@ -161,6 +282,12 @@ class template_ensemble(object):
 
         log = get_logger()
 
+        cache_filename = None
+        if cache_dir is not None :
+            cache_filename = self.template_cache_filename(cache_dir, nmodel, redshifts=redshifts, mags=mags, single_mag=single_mag)
+            if os.path.isfile(cache_filename) :
+                log.info('Reading cached {} templates from {}'.format(self.tracer, cache_filename))
+                return read_template_cache(cache_filename)
 
         # https://arxiv.org/pdf/1611.00036.pdf
         #
@@ -176,8 +303,6 @@ class template_ensemble(object):
         rel_loss = -(self.config.wgt_fiberloss - self.config.psf_fiberloss) / 2.5
         rel_loss = 10.**rel_loss
 
-        magrange = (self.config.med_mag, self.config.limit_mag)
-
         log.info('{} nmodel: {:d}'.format(self.tracer, nmodel))
         log.info('{} filter: {}'.format(self.tracer, self.config.filter))
         log.info('{} zrange: {} - {}'.format(self.tracer, zrange[0], zrange[1]))
@@ -196,64 +321,29 @@ class template_ensemble(object):
         log.info('psf fiberloss: {:.3f}'.format(psf_loss))
         log.info('Relative fiberloss to psf morphtype: {:.3f}'.format(rel_loss))
         log.info('Generating templates ...')
-        if self.tracer == 'bgs':
-            # Cut on mag.
-            # https://github.com/desihub/desitarget/blob/dd353c6c8dd8b8737e45771ab903ac30584db6db/py/desitarget/cuts.py#L1312
-            magrange = (self.config.med_mag, self.config.limit_mag)
-            if single_mag and mags is None : mags=np.repeat( self.effmag(magrange[0],magrange[1]) , nmodel)
-
-            maker = desisim.templates.BGS(wave=self.wave, normfilter_south=normfilter_south)
-            flux, wave, meta, objmeta = maker.make_templates(nmodel=nmodel, redshift=redshifts, mag=mags, south=True, zrange=zrange, magrange=magrange, seed=self.seed)
+        if self.tracer not in TRACER_TEMPLATES :
+            raise  ValueError('{} is not an available tracer.'.format(self.tracer))
 
-            # Additional factor rel. to psf.; TSNR put onto instrumental
-            # e/A given calibration vector that includes psf-like loss.
-            flux *= rel_loss
+        classname, magrange_keys, fibmag_normalized = TRACER_TEMPLATES[self.tracer]
 
-        elif self.tracer == 'lrg':
-            # Cut on fib. mag. with desisim.templates setting FIBERFLUX to FLUX.
-            # https://github.com/desihub/desitarget/blob/dd353c6c8dd8b8737e45771ab903ac30584db6db/py/desitarget/cuts.py#L447
-            magrange = (self.config.med_fibmag, self.config.limit_fibmag)
-            # consistent with tsnr on disk
-            #magrange = (self.config.med_mag, self.config.limit_mag)
-            if single_mag and mags is None : mags=np.repeat( self.effmag(magrange[0],magrange[1]) , nmodel)
+        magrange = (getattr(self.config, magrange_keys[0]), getattr(self.config, magrange_keys[1]))
+        if single_mag and mags is None : mags=np.repeat( self.effmag(magrange[0],magrange[1]) , nmodel)
 
-            maker = desisim.templates.LRG(wave=self.wave, normfilter_south=normfilter_south)
-            flux, wave, meta, objmeta = maker.make_templates(nmodel=nmodel, redshift=redshifts, mag=mags, south=True, zrange=zrange, magrange=magrange, seed=self.seed)
+        maker = getattr(desisim.templates, classname)(wave=self.wave, normfilter_south=normfilter_south)
+        flux, wave, meta, objmeta = maker.make_templates(nmodel=nmodel, redshift=redshifts, mag=mags, south=True, zrange=zrange, magrange=magrange, seed=self.seed)
 
+        if fibmag_normalized :
             # Take factor rel. to psf.; TSNR put onto instrumental
             # e/A given calibration vector that includes psf-like loss.
             # Note:  Oppostive to other tracers as templates normalized to fibermag.
-            flux /= psf_loss
-            #flux *= rel_loss
-
-        elif self.tracer == 'elg':
-            # Cut on mag.
-            # https://github.com/desihub/desitarget/blob/dd353c6c8dd8b8737e45771ab903ac30584db6db/py/desitarget/cuts.py#L517
-            magrange = (self.config.med_mag, self.config.limit_mag)
-            if single_mag and mags is None : mags=np.repeat( self.effmag(magrange[0],magrange[1]) , nmodel)
-
-            maker = desisim.templates.ELG(wave=self.wave, normfilter_south=normfilter_south)
-            flux, wave, meta, objmeta = maker.make_templates(nmodel=nmodel, redshift=redshifts, mag=mags, south=True, zrange=zrange, magrange=magrange, seed=self.seed)
-
-            # Additional factor rel. to psf.; TSNR put onto instrumental
-            # e/A given calibration vector that includes psf-like loss.
-            flux *= rel_loss
-
-        elif self.tracer == 'qso':
-            # Cut on mag.
-            # https://github.com/desihub/desitarget/blob/dd353c6c8dd8b8737e45771ab903ac30584db6db/py/desitarget/cuts.py#L1422
-            magrange = (self.config.med_mag, self.config.limit_mag)
-            if single_mag and mags is None : mags=np.repeat( self.effmag(magrange[0],magrange[1]) , nmodel)
-
-            maker = desisim.templates.QSO(wave=self.wave, normfilter_south=normfilter_south)
-            flux, wave, meta, objmeta = maker.make_templates(nmodel=nmodel, redshift=redshifts, mag=mags, south=True, zrange=zrange, magrange=magrange, seed=self.seed)
-
+            flux_scale = 1. / psf_loss
+        else :
             # Additional factor rel. to psf.; TSNR put onto instrumental
             # e/A given calibration vector that includes psf-like loss.
-            flux *= rel_loss
+            flux_scale = rel_loss
 
-        else:
-            raise  ValueError('{} is not an available tracer.'.format(self.tracer))
+        # scale and convert to single precision (enough for dF) in the same pass
+        flux = np.multiply(flux, flux_scale, dtype=np.float32)
 
         if single_mag :
             log.info('{} single effective mag: {}'.format(self.tracer, mags[0]))
@@ -261,9 +351,13 @@ class template_ensemble(object):
             log.info('{} magrange: {} - {}'.format(self.tracer, magrange[0], magrange[1]))
         log.info("  Done generating templates")
 
+        if cache_filename is not None :
+            write_template_cache(cache_filename, wave, flux, meta, objmeta)
+            log.info('Cached {} templates to {}'.format(self.tracer, cache_filename))
+
         return  wave, flux, meta, objmeta
 
-    def compute(self, nmodel=5, smooth=100., nz_table_filename=None, single_mag=True, convolve_to_nz=True):
+    def compute(self, nmodel=5, smooth=100., nz_table_filename=None, single_mag=True, convolve_to_nz=True, cache_dir=None):
         """
         Compute a template ensemble for template S/N measurements (tSNR)
 
@@ -273,13 +367,18 @@ class template_ensemble(object):
             nz_table_filename: path to ASCII file with columns zmin,zmax,n
             single_mag: generate all templates at same average magnitude to limit MC noise
             convolve_to_nz: if True, each template dF^2 is convolved to match the n(z) (redshift distribution)
+            cache_dir: if set, directory where generated templates are cached for reruns
         """
         log = get_logger()
 
         if nz_table_filename is None :
             nz_table_filename = os.environ['DESIMODEL'] + '/data/targets/nz_{}.dat'.format(self.tracer)
 
-        _, flux, meta, objmeta         = self.generate_templates(nmodel=nmodel,single_mag=single_mag)
+        _, flux, meta, objmeta         = self.generate_templates(nmodel=nmodel,single_mag=single_mag,cache_dir=cache_dir)
+
+        # single precision is enough for dF and halves the memory traffic of the smoothing and stacking
+        # (no copy for templates from generate_templates, which are already float32)
+        flux = np.ascontiguousarray(flux, dtype=np.float32)
 
         # keep a copy of the templates meta data
         self.meta = meta
@@ -287,21 +386,16 @@ class template_ensemble(object):
             if k not in self.meta.dtype.names :
                 self.meta[k] = objmeta[k]
 
-        self.ensemble_flux             = {}
-        self.ensemble_dflux            = {}
         self.ensemble_meta             = meta
         self.ensemble_objmeta          = objmeta
         self.ensemble_dflux_stack      = {}
         self.smooth = smooth
 
         ##
-        smoothing = np.ceil(smooth / self.wdelta).astype(int)
+        smoothing = int(np.ceil(smooth / self.wdelta))
 
         log.info('Applying {:.3f} AA smoothing ({:d} pixels)'.format(smooth, smoothing))
-        dflux = flux.copy()
-        for i in range(flux.shape[0]):
-            sflux  = convolve(flux[i], Box1DKernel(smoothing), boundary='extend')
-            dflux[i] -= sflux
+        dflux = smooth_residuals(flux, smoothing)
 
         log.info("Read N(z) in {}".format(nz_table_filename))
         zmin, zmax, numz = np.loadtxt(nz_table_filename, unpack=True, usecols = (0,1,2))
@@ -324,7 +418,6 @@ class template_ensemble(object):
             # map to log scale for fast convolution with dndz
             lwave = np.log(self.wave)
             loggrid_lwave = np.linspace(lwave[0],lwave[-1],lwave.size) # linear grid of log(wave)
-            loggrid_dflux = np.zeros(dflux.shape)
             loggrid_step = loggrid_lwave[1]-loggrid_lwave[0]
 
             loggrid_lzmin = np.log(1+zmid[0])
@@ -340,36 +433,42 @@ class template_ensemble(object):
             loggrid_nz /= np.sum(loggrid_nz)
             central_lz = loggrid_lz[loggrid_lz.size//2]
 
-            zconv_dflux = np.zeros(dflux.shape)
-            for i in range(dflux.shape[0]):
+            zs = np.asarray(meta['REDSHIFT'], dtype=float)
+            zconv_dflux = np.empty_like(dflux)
+
+            def _convolve_to_nz(i) :
                 lwave_dflux = np.interp(loggrid_lwave,lwave,dflux[i])
-                zi=float(self.meta['REDSHIFT'][i])
-                kern = np.interp(loggrid_lz+(np.log(1+zi)-central_lz),loggrid_lz,loggrid_nz,left=0,right=0)
-                if np.sum(kern)==0 : continue
+                kern = np.interp(loggrid_lz+(np.log(1+zs[i])-central_lz),loggrid_lz,loggrid_nz,left=0,right=0)
+                if np.sum(kern)==0 :
+                    zconv_dflux[i] = 0.
+                    return
                 kern/=np.sum(kern)
                 lwave_convolved_dflux2 = fftconvolve(lwave_dflux**2,kern,mode="same")
                 zconv_dflux2 = np.interp(lwave,loggrid_lwave,lwave_convolved_dflux2,left=0,right=0)
                 zconv_dflux[i] = np.sqrt(zconv_dflux2*(zconv_dflux2>0))
-            dflux = zconv_dflux
 
-        # Generate template (d)fluxes for brz bands.
-        for band in ['b', 'r', 'z']:
-            band_wave                 = self.wave[self.cslice[band]]
-            in_band                   = np.isin(self.wave, band_wave)
-            self.ensemble_flux[band]  = flux[:, in_band]
-            self.ensemble_dflux[band] = dflux[:, in_band]
+            # templates are independent, and the interpolations and FFTs
+            # do not hold the GIL, so convolve them in threads
+            with ThreadPoolExecutor() as ex:
+                list(ex.map(_convolve_to_nz, range(dflux.shape[0])))
 
-        zs = meta['REDSHIFT'].data
+            dflux = zconv_dflux
 
-        # Stack ensemble.
+        # Stack ensemble: rms of dflux, computed once on the full wavelength grid
+        # (without a squared dflux temporary) and shared by the overlapping bands.
+        # The sum over templates is accumulated in double precision.
+        dflux_rms = np.sqrt(np.einsum('ij,ij->j', dflux, dflux, dtype=np.float64) / dflux.shape[0]).astype(np.float32)
+
+        # Only the stacks are kept for the brz bands, so that the (nmodel, nwave)
+        # flux and dflux arrays are released when returning.
         for band in ['b', 'r', 'z']:
-            self.ensemble_dflux_stack[band] = np.sqrt(np.average(self.ensemble_dflux[band]**2., axis=0).reshape(1, len(self.ensemble_dflux[band].T)))
+            self.ensemble_dflux_stack[band] = dflux_rms[None, self.cslice[band]]
 
     def write(self,filename) :
 
         log = get_logger()
 
-        hdr = fits.Header()
+        hdr = fitsio.FITSHDR()
         hdr['TRACER']   = self.tracer
         hdr['FILTER']   = self.config.filter
         hdr['ZLO']      = self.config.zlo
@@ -381,21 +480,18 @@ class template_ensemble(object):
         hdr['SMOOTH']   = self.smooth
         hdr['SEED']   = self.seed
 
-        hdu_list = [fits.PrimaryHDU(header=hdr)]
-
-        for band in ['b', 'r', 'z']:
-            hdu_list.append(fits.ImageHDU(self.wave[self.cslice[band]], name='WAVE_{}'.format(band.upper())))
-            hdu_list.append(fits.ImageHDU(self.ensemble_dflux_stack[band], name='DFLUX_{}'.format(band.upper())))
-
-        hdu_list = fits.HDUList(hdu_list)
+        tmpfile = get_tempfilename(filename)
+        with fitsio.FITS(tmpfile, 'rw', clobber=True) as fx:
+            fx.write(None, header=hdr)
 
-        self.meta.meta={"EXTNAME":"TEMPLATES_META"}
-        hdu_list.append(fits.convenience.table_to_hdu(self.meta))
+            for band in ['b', 'r', 'z']:
+                fx.write(self.wave[self.cslice[band]], extname='WAVE_{}'.format(band.upper()))
+                fx.write(self.ensemble_dflux_stack[band], extname='DFLUX_{}'.format(band.upper()))
 
-        self.nz.meta={"EXTNAME":"NZ"}
-        hdu_list.append(fits.convenience.table_to_hdu(self.nz))
+            fx.write(self.meta.as_array(), extname='TEMPLATES_META')
+            fx.write(self.nz.as_array(), extname='NZ')
 
-        hdu_list.writeto(filename, overwrite=True)
+        os.rename(tmpfile, filename)
 
         log.info('Successfully written to '+filename)
 
@@ -425,7 +521,7 @@ def get_ensemble(dirpath=None, bands=["b","r","z"], smooth=0):
     if dirpath is None :
         dirpath = os.path.join(os.environ["DESIMODEL"],"data/tsnr")
 
-    paths = glob.glob(dirpath + '/tsnr-ensemble-*.fits')
+    paths = glob.glob(ensemble_filename(dirpath, '*'))
 
     wave = {}
     flux = {}
@@ -437,26 +533,27 @@ def get_ensemble(dirpath=None, bands=["b","r","z"], smooth=0):
 
     for path in paths:
         tracer = path.split('/')[-1].split('-')[2].replace('.fits','')
-        dat    = fits.open(path)
+        with fitsio.FITS(path) as fx:
+            hdr = fx[0].read_header()
 
-        if 'FLUXSCAL' in dat[0].header :
-            scale_factor = dat[0].header['FLUXSCAL']
-            log.info("for {} apply scale factor = {:4.3f}".format(path,scale_factor))
-        else :
-            scale_factor = 1.
+            if 'FLUXSCAL' in hdr :
+                scale_factor = hdr['FLUXSCAL']
+                log.info("for {} apply scale factor = {:4.3f}".format(path,scale_factor))
+            else :
+                scale_factor = 1.
 
-        for band in bands:
-            wave[band] = dat['WAVE_{}'.format(band.upper())].data
-            flux[band] = scale_factor*dat['DFLUX_{}'.format(band.upper())].data
-            ivar[band] = 1.e99 * np.ones_like(flux[band])
+            for band in bands:
+                wave[band] = fx['WAVE_{}'.format(band.upper())].read()
+                flux[band] = scale_factor*fx['DFLUX_{}'.format(band.upper())].read()
+                # float64 even for the float32 DFLUX stacks, where 1e99 would overflow
+                ivar[band] = np.full(flux[band].shape, 1.e99)
 
-            # 125: 100. A in 0.8 pixel.
-            if smooth > 0:
-                flux[band] = convolve(flux[band][0,:], Box1DKernel(smooth), boundary='extend')
-                flux[band] = flux[band].reshape(1, len(flux[band]))
+                # 125: 100. A in 0.8 pixel.
+                if smooth > 0:
+                    flux[band] = flux[band] - smooth_residuals(flux[band], smooth)
 
         ensembles[tracer] = Spectra(bands, wave, flux, ivar)
-        ensembles[tracer].meta = dat[0].header
+        ensembles[tracer].meta = hdr
 
     duration = time.time() - t0
 
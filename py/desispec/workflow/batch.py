@@ -3,6 +3,8 @@ desispec.workflow.batch: utilities for working with slurm batch queues
 """
 
 import os
+import copy
+import functools
 from pkg_resources import resource_filename
 import yaml
 
@@ -27,14 +29,19 @@ def get_config(name):
     if name is None:
         name = default_system()
 
+    #- copy so that callers can't modify the cached configuration
+    return copy.deepcopy(_read_config_file()[name])
+
+@functools.lru_cache()
+def _read_config_file():
+    """
+    Return the parsed batch configuration file, read only once per process
+    """
     configfile = resource_filename('desispec', 'data/batch_config.yaml')
     with open(configfile) as fx:
         config = yaml.safe_load(fx)
 
-    #- Add the name for reference, in case it was default selected
-    config['name'] = name
-
-    return config[name]
+    return config
 
 def default_system():
     """
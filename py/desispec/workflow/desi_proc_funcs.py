@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 
-import time
+import datetime
 
-import sys, os, argparse, re
+import sys, os, argparse
+import string
+import functools
 
 import numpy as np
 import fitsio
@@ -15,6 +17,9 @@ from desiutil.log import get_logger
 
 from . import batch
 
+#- Extension names of camera HDUs in raw data files (case insensitive), in sorted order
+_CAMERA_NAMES = tuple('{}{}'.format(band, spectro) for band in 'brz' for spectro in range(10))
+
 def get_desi_proc_parser():
     """
     Create an argparser object for use with desi_proc based on arguments from sys.argv
@@ -105,6 +110,9 @@ def add_desi_proc_joint_fit_terms(parser):
 
     return parser
 
+#- Set by assign_mpi once the MPI environment variables have been checked
+_mpi_env_checked = False
+
 def assign_mpi(do_mpi, do_batch, log):
     """
     Based on whether the mpi flag is set and whether the batch flag is set, assign the appropriate
@@ -132,21 +140,26 @@ def assign_mpi(do_mpi, do_batch, log):
         rank = 0
         size = 1
 
-    #- Prevent MPI from killing off spawned processes
-    if 'PMI_MMAP_SYNC_WAIT_TIME' not in os.environ:
-        os.environ['PMI_MMAP_SYNC_WAIT_TIME'] = '3600'
-
-    #- Double check env for MPI+multiprocessing at NERSC
-    if 'MPICH_GNI_FORK_MODE' not in os.environ:
-        os.environ['MPICH_GNI_FORK_MODE'] = 'FULLCOPY'
-        if rank == 0:
-            log.info('Setting MPICH_GNI_FORK_MODE=FULLCOPY for MPI+multiprocessing')
-    elif os.environ['MPICH_GNI_FORK_MODE'] != 'FULLCOPY':
-        gnifork = os.environ['MPICH_GNI_FORK_MODE']
-        if rank == 0:
-            log.error(f'MPICH_GNI_FORK_MODE={gnifork} is not "FULLCOPY"; this might not work with MPI+multiprocessing, but not overriding')
-    elif rank == 0:
-        log.debug('MPICH_GNI_FORK_MODE={}'.format(os.environ['MPICH_GNI_FORK_MODE']))
+    #- The environment only needs to be checked once per process
+    global _mpi_env_checked
+    if not _mpi_env_checked:
+        #- Prevent MPI from killing off spawned processes
+        if 'PMI_MMAP_SYNC_WAIT_TIME' not in os.environ:
+            os.environ['PMI_MMAP_SYNC_WAIT_TIME'] = '3600'
+
+        #- Double check env for MPI+multiprocessing at NERSC
+        if 'MPICH_GNI_FORK_MODE' not in os.environ:
+            os.environ['MPICH_GNI_FORK_MODE'] = 'FULLCOPY'
+            if rank == 0:
+                log.info('Setting MPICH_GNI_FORK_MODE=FULLCOPY for MPI+multiprocessing')
+        elif os.environ['MPICH_GNI_FORK_MODE'] != 'FULLCOPY':
+            gnifork = os.environ['MPICH_GNI_FORK_MODE']
+            if rank == 0:
+                log.error(f'MPICH_GNI_FORK_MODE={gnifork} is not "FULLCOPY"; this might not work with MPI+multiprocessing, but not overriding')
+        elif rank == 0:
+            log.debug('MPICH_GNI_FORK_MODE={}'.format(os.environ['MPICH_GNI_FORK_MODE']))
+
+        _mpi_env_checked = True
 
     return comm, rank, size
 
@@ -165,15 +178,10 @@ def load_raw_data_header(pathname, return_filehandle=False):
     """
     # - Fill in values from raw data header if not overridden by command line
     fx = fitsio.FITS(pathname)
-    if 'SPEC' in fx:  # - 20200225 onwards
-        # hdr = fits.getheader(args.input, 'SPEC')
-        hdr = fx['SPEC'].read_header()
-    elif 'SPS' in fx:  # - 20200224 and before
-        # hdr = fits.getheader(args.input, 'SPS')
-        hdr = fx['SPS'].read_header()
-    else:
-        # hdr = fits.getheader(args.input, 0)
-        hdr = fx[0].read_header()
+    # - SPEC from 20200225 onwards, SPS for 20200224 and before, else the primary HDU
+    extnames = {hdu.get_extname().upper() for hdu in fx}
+    ext = next((name for name in ('SPEC', 'SPS') if name in extnames), 0)
+    hdr = fx[ext].read_header()
 
     if return_filehandle:
         return hdr, fx
@@ -190,24 +198,60 @@ def cameras_from_raw_data(rawdata):
         rawdata, str or fitsio.FITS object. The input raw desi data file. str must be a full file path. Otherwise
                                             it must be a fitsio.FITS object.
     Returns:
-        cameras, str. The list of cameras that have data in the given file.
+        cameras, str. The sorted list of cameras that have data in the given file.
     """
     ## Be flexible on whether input is filepath or a filehandle
     if type(rawdata) is str:
         if os.path.isfile(rawdata):
-            fx = fitsio.FITS(rawdata)
+            with fitsio.FITS(rawdata) as fx:
+                extnames = [hdu.get_extname() for hdu in fx]
         else:
             raise IOError(f"File {rawdata} doesn't exist.")
     else:
-        fx = rawdata
+        extnames = [hdu.get_extname() for hdu in rawdata]
 
-    recam = re.compile('^[brzBRZ][\d]$')
-    cameras = list()
-    for hdu in fx.hdu_list:
-        if recam.match(hdu.get_extname()):
-            cameras.append(hdu.get_extname().lower())
+    extnames = {extname.lower() for extname in extnames}
+    cameras = [cam for cam in _CAMERA_NAMES if cam in extnames]
     return cameras
 
+@functools.lru_cache(maxsize=64)
+def _read_raw_data_headers(pathname, mtime_ns, cameras=None):
+    """
+    Read the spectrograph header and the camera headers of a raw data file.
+    Cached on (pathname, mtime_ns, cameras) so that repeated calls within a
+    process do not re-read an unchanged file; callers should copy the headers
+    before modifying them.
+
+    Args:
+        pathname: str, the full path to the raw data file
+        mtime_ns: int, modification time of the file (os.stat(pathname).st_mtime_ns)
+        cameras: tuple of str, the cameras whose headers to read. Default (None) is
+                 all cameras that have data in the file.
+
+    Returns:
+        hdr: fitsio header object of the spectrograph HDU
+        cameras: tuple of str, the cameras that have data in the file if the
+                 cameras argument is None, otherwise the input cameras
+        camhdr: dict, fitsio header object for each camera in cameras
+
+    Raises:
+        IOError if a requested camera is missing from the file
+    """
+    hdr, fx = load_raw_data_header(pathname=pathname, return_filehandle=True)
+    try:
+        if cameras is None:
+            cameras = tuple(cameras_from_raw_data(fx))
+        else:
+            missing = set(cameras) - set(cameras_from_raw_data(fx))
+            if len(missing) > 0:
+                raise IOError('Missing camera(s) {} in {}'.format(sorted(missing), pathname))
+
+        camhdr = {cam: fx[cam].read_header() for cam in cameras}
+    finally:
+        fx.close()
+
+    return hdr, cameras, camhdr
+
 def update_args_with_headers(args):
     """
     Update input argparse object with values from header if the argparse values are uninformative defaults (generally
@@ -236,7 +280,17 @@ def update_args_with_headers(args):
     if not os.path.isfile(args.input):
         raise IOError('Missing input file: {}'.format(args.input))
 
-    hdr, fx = load_raw_data_header(pathname=args.input, return_filehandle=True)
+    #- only read the headers of the requested cameras, if any
+    if args.cameras is not None:
+        camword = parse_cameras(args.cameras)
+        args.cameras = decode_camword(camword)
+        cameras = tuple(args.cameras)
+    else:
+        cameras = None
+
+    rawhdr, rawcameras, rawcamhdr = _read_raw_data_headers(args.input, os.stat(args.input).st_mtime_ns,
+                                                           cameras=cameras)
+    hdr = fitsio.FITSHDR(rawhdr)
 
     if args.expid is None:
         args.expid = int(hdr['EXPID'])
@@ -254,17 +308,14 @@ def update_args_with_headers(args):
             raise RuntimeError('Need --obstype or OBSTYPE or FLAVOR header keywords')
 
     if args.cameras is None:
-        cameras = cameras_from_raw_data(fx)
+        cameras = list(rawcameras)
         if len(cameras) == 0:
             raise RuntimeError("No [BRZ][0-9] camera HDUs found in {}".format(args.input))
 
         args.cameras = cameras
-    else:
-        camword = parse_cameras(args.cameras)
-        args.cameras = decode_camword(camword)
 
     # - Update args to be in consistent format
-    args.cameras = sorted(args.cameras)
+    # - (cameras_from_raw_data and decode_camword both return sorted cameras)
     args.obstype = args.obstype.upper()
     args.night = int(args.night)
     if args.batch_opts is not None:
@@ -272,12 +323,11 @@ def update_args_with_headers(args):
 
     camhdr = dict()
     for cam in args.cameras:
-        camhdr[cam] = fx[cam].read_header()
+        camhdr[cam] = fitsio.FITSHDR(rawcamhdr[cam])
 
-    fx.close()
     return args, hdr, camhdr
 
-def determine_resources(ncameras, jobdesc, queue, nexps=1, forced_runtime=None, system_name=None):
+def determine_resources(ncameras, jobdesc, queue, nexps=1, forced_runtime=None, system_name=None, batch_config=None):
     """
     Determine the resources that should be assigned to the batch script given what
     desi_proc needs for the given input information.
@@ -289,13 +339,18 @@ def determine_resources(ncameras, jobdesc, queue, nexps=1, forced_runtime=None,
                     restrictions on number of nodes.
         force_runtime: int, the amount of runtime in minutes to allow for the script. Should be left
                             to default heuristics unless needed for some reason.
+        system_name: str, batch system name, e.g. cori-haswell, perlmutter-gpu. Ignored if batch_config is given.
+        batch_config: dict, batch system configuration from desispec.workflow.batch.get_config(system_name),
+                            if already available to the caller.
 
     Returns:
         ncores: int, number of cores (actually 2xphysical cores) that should be submitted via "-n {ncores}"
         nodes:  int, number of nodes to be requested in the script. Typically  (ncores-1) // cores_per_node + 1
         runtime: int, the max time requested for the script in minutes for the processing.
     """
-    config = batch.get_config(system_name)
+    if batch_config is None:
+        batch_config = batch.get_config(system_name)
+    config = batch_config
 
     nspectro = (ncameras - 1) // 3 + 1
     if jobdesc in ('ARC', 'TESTARC'):
@@ -380,15 +435,14 @@ def get_desi_proc_batch_file_name(night, exp, jobdesc, cameras):
         pathname: str, the default script name for a desi_proc batch script file
     """
     camword = parse_cameras(cameras)
-    if type(exp) is not str:
-        if np.isscalar(exp):
-            expstr = '{:08d}'.format(exp)
-        else:
-            #expstr = '-'.join(['{:08d}'.format(curexp) for curexp in exp])
-            expstr = '{:08d}'.format(exp[0])
-    else:
+    if isinstance(exp, (int, np.integer)):
+        expstr = f'{exp:08d}'
+    elif isinstance(exp, str):
         expstr = exp
-    jobname = '{}-{}-{}-{}'.format(jobdesc.lower(), night, expstr, camword)
+    else:
+        #expstr = '-'.join([f'{curexp:08d}' for curexp in exp])
+        expstr = f'{exp[0]:08d}'
+    jobname = f'{jobdesc.lower()}-{night}-{expstr}-{camword}'
     return jobname
 
 def get_desi_proc_batch_file_pathname(night, exp, jobdesc, cameras, reduxdir=None):
@@ -410,6 +464,88 @@ def get_desi_proc_batch_file_pathname(night, exp, jobdesc, cameras, reduxdir=Non
     return os.path.join(path, name)
 
 
+@functools.lru_cache()
+def _batch_script_template(jobdesc, system_name, nightlybias):
+    """
+    Return the layout of a desi_proc batch script, which only depends on the
+    type of job, the batch system and whether it is a nightlybias job
+
+    Args:
+        jobdesc: str, lower case type of data being processed
+        system_name: str, name of batch system, e.g. cori-haswell, cori-knl
+        nightlybias: bool, whether this is a nightlybias job
+
+    Returns:
+        template: string.Template with ${jobdesc}, ${nodes}, ${queue}, ${batch_opts},
+                  ${jobname}, ${batchdir}, ${runtime}, ${ncameras}, ${ncores},
+                  ${threads_per_core}, ${ntasks}, ${threads_per_task} and ${cmd} placeholders
+    """
+    batch_config = batch.get_config(system_name)
+
+    lines = ['#!/bin/bash -l\n\n',
+             '#SBATCH -N ${nodes}\n',
+             '#SBATCH --qos ${queue}\n']
+    for opts in batch_config['batch_opts']:
+        lines.append('#SBATCH {}\n'.format(opts.replace('$', '$$')))
+    lines.extend([
+        '${batch_opts}',
+        '#SBATCH --account desi\n',
+        '#SBATCH --job-name ${jobname}\n',
+        '#SBATCH --output ${batchdir}/${jobname}-%j.log\n',
+        '#SBATCH --time=${runtime}\n',
+        '#SBATCH --exclusive\n',
+        '\n',
+        '# ${jobdesc} exposure with ${ncameras} cameras\n',
+        '# using ${ncores} cores on ${nodes} nodes\n\n',
+        'echo Starting at $$(date)\n',
+    ])
+
+    if jobdesc == 'arc':
+        lines.append('export OMP_NUM_THREADS=${threads_per_core}\n')
+    else:
+        lines.append('export OMP_NUM_THREADS=1\n')
+
+    if jobdesc not in ['science', 'prestdstar', 'stdstarfit', 'poststdstar']:
+        if nightlybias:
+            lines.append('\n# Ranks throttled due to high memory --nightlybias\n')
+        else:
+            lines.append('\n# Do steps at full MPI parallelism\n')
+
+        srun = 'srun -N ${nodes} -n ${ncores} -c ${threads_per_core} ${cmd}'
+        lines.append(f'echo Running {srun}\n')
+        lines.append(f'{srun}\n')
+    else:
+        if jobdesc in ['science','prestdstar']:
+            lines.append('\n# Do steps through skysub at full MPI parallelism\n')
+            srun = 'srun -N ${nodes} -n ${ncores} -c ${threads_per_core} --cpu-bind=cores ${cmd} --nofluxcalib'
+            lines.append(f'echo Running {srun}\n')
+            lines.append(f'{srun}\n')
+        if jobdesc in ['science', 'stdstarfit', 'poststdstar']:
+            lines.append('\n# Use less MPI parallelism for fluxcalib MP parallelism\n')
+            lines.append('# This should quickly skip over the steps already done\n')
+            #- fluxcalib multiprocessing parallelism needs --cpu-bind=none (or at least not "cores")
+            srun = 'srun -N ${nodes} -n ${ntasks} -c ${threads_per_task} --cpu-bind=none ${cmd} '
+            lines.extend([
+                'if [ $$? -eq 0 ]; then\n',
+                f'  echo Running {srun}\n',
+                f'  {srun}\n',
+                'else\n',
+                '  echo FAILED: done at $$(date)\n',
+                '  exit 1\n',
+                'fi\n',
+            ])
+
+    lines.extend([
+        '\nif [ $$? -eq 0 ]; then\n',
+        '  echo SUCCESS: done at $$(date)\n',
+        'else\n',
+        '  echo FAILED: done at $$(date)\n',
+        '  exit 1\n',
+        'fi\n',
+    ])
+
+    return string.Template(''.join(lines))
+
 def create_desi_proc_batch_script(night, exp, cameras, jobdesc, queue, runtime=None, batch_opts=None,\
                                   timingfile=None, batchdir=None, jobname=None, cmdline=None, system_name=None):
     """
@@ -447,7 +583,7 @@ def create_desi_proc_batch_script(night, exp, cameras, jobdesc, queue, runtime=N
         batchdir and jobname can be used to define an alternative pathname, but may not work with assumptions in desi_proc.
             These optional arguments should be used with caution and primarily for debugging.
     """
-    if np.isscalar(cameras):
+    if isinstance(cameras, str):
         camword = cameras
         cameras = decode_camword(camword)
 
@@ -466,14 +602,16 @@ def create_desi_proc_batch_script(night, exp, cameras, jobdesc, queue, runtime=N
     scriptfile = os.path.join(batchdir, jobname + '.slurm')
 
     batch_config = batch.get_config(system_name)
-    threads_per_core = batch_config['threads_per_core']
+    threads_per_core = int(batch_config['threads_per_core'])
+    threads_per_node = threads_per_core * int(batch_config['cores_per_node'])
+    mem_per_node = float(batch_config['memory'])
 
     ncameras = len(cameras)
     nexps = 1
-    if not np.isscalar(exp) and type(exp) is not str:
+    if not isinstance(exp, (str, int, np.integer)):
         nexps = len(exp)
     ncores, nodes, runtime = determine_resources(ncameras, jobdesc.upper(), queue=queue, nexps=nexps,
-            forced_runtime=runtime, system_name=system_name)
+            forced_runtime=runtime, batch_config=batch_config)
 
     #- derive from cmdline or sys.argv whether this is a nightlybias job
     nightlybias = False
@@ -486,125 +624,76 @@ def create_desi_proc_batch_script(night, exp, cameras, jobdesc, queue, runtime=N
     #- nightlybias jobs are memory limited, so throttle number of ranks
     if nightlybias:
         ncores = min(ncores, 8)
-        tot_threads = batch_config['threads_per_core'] * batch_config['cores_per_node']
-        threads_per_core = tot_threads // 8
+        threads_per_core = threads_per_node // 8
 
     #- arc fits require 3.2 GB of memory per bundle, so increase nodes as needed
     if jobdesc.lower() == 'arc':
-        cores_per_node = (ncores-1) // nodes + ((ncores-1) % nodes > 0)
-        mem_per_node = float(batch_config['memory'])
-        mem_per_core = mem_per_node / cores_per_node
-        while mem_per_core < 3.2:
-            nodes += 1
-            cores_per_node = (ncores-1) // nodes + ((ncores-1) % nodes > 0)
-            mem_per_core = mem_per_node / cores_per_node
-        threads_per_node = batch_config['threads_per_core'] * batch_config['cores_per_node']
+        #- the ncores-1 bundle ranks need mem_per_node / cores_per_node >= 3.2.
+        #- Use true division rather than // so that exact multiples of 3.2 GB
+        #- (e.g. 64 GB -> 20 cores) aren't rounded down
+        max_cores_per_node = int(mem_per_node / 3.2)
+        if max_cores_per_node > 0:
+            nodes = max(nodes, -(-(ncores-1) // max_cores_per_node))
         threads_per_core = (threads_per_node * nodes) // ncores
 
     runtime_hh = int(runtime // 60)
     runtime_mm = int(runtime % 60)
 
-    with open(scriptfile, 'w') as fx:
-        fx.write('#!/bin/bash -l\n\n')
-        fx.write('#SBATCH -N {}\n'.format(nodes))
-        fx.write('#SBATCH --qos {}\n'.format(queue))
-        for opts in batch_config['batch_opts']:
-            fx.write('#SBATCH {}\n'.format(opts))
-        if batch_opts is not None:
-            fx.write('#SBATCH {}\n'.format(batch_opts))
-        fx.write('#SBATCH --account desi\n')
-        fx.write('#SBATCH --job-name {}\n'.format(jobname))
-        fx.write('#SBATCH --output {}/{}-%j.log\n'.format(batchdir, jobname))
-        fx.write('#SBATCH --time={:02d}:{:02d}:00\n'.format(runtime_hh, runtime_mm))
-        fx.write('#SBATCH --exclusive\n')
-
-        fx.write('\n')
-
-        if cmdline is None:
-            inparams = list(sys.argv).copy()
-        elif np.isscalar(cmdline):
-            inparams = []
-            for param in cmdline.split(' '):
-                for subparam in param.split("="):
-                    inparams.append(subparam)
-        else:
-            inparams = list(cmdline)
-        for parameter in ['--queue', '-q', '--batch-opts']:
-            ## If a parameter is in the list, remove it and its argument
-            ## Elif it is a '--' command, it might be --option=value, which won't be split.
-            ##      check for that and remove the whole "--option=value"
-            if parameter in inparams:
-                loc = np.where(np.array(inparams) == parameter)[0][0]
-                # Remove the command
-                inparams.pop(loc)
-                # Remove the argument of the command (now in the command location after pop)
-                inparams.pop(loc)
-            elif '--' in parameter:
-                for ii,inparam in enumerate(inparams.copy()):
-                    if parameter in inparam:
-                        inparams.pop(ii)
-                        break
-
-        cmd = ' '.join(inparams)
-        cmd = cmd.replace(' --batch', ' ').replace(' --nosubmit', ' ')
-        cmd += f' --timingfile {timingfile}'
-
-        if '--mpi' not in cmd:
-            cmd += ' --mpi'
-
-        fx.write(f'# {jobdesc} exposure with {ncameras} cameras\n')
-        fx.write(f'# using {ncores} cores on {nodes} nodes\n\n')
-
-        fx.write('echo Starting at $(date)\n')
-
-        if jobdesc.lower() == 'arc':
-            fx.write("export OMP_NUM_THREADS={}\n".format(threads_per_core))
-        else:
-            fx.write("export OMP_NUM_THREADS=1\n")
-        
-        if jobdesc.lower() not in ['science', 'prestdstar', 'stdstarfit', 'poststdstar']:
-            if nightlybias:
-                fx.write('\n# Ranks throttled due to high memory --nightlybias\n')
-            else:
-                fx.write('\n# Do steps at full MPI parallelism\n')
-
-            srun = f'srun -N {nodes} -n {ncores} -c {threads_per_core} {cmd}'
-            fx.write('echo Running {}\n'.format(srun))
-            fx.write('{}\n'.format(srun))
+    if cmdline is None:
+        inparams = list(sys.argv).copy()
+    elif isinstance(cmdline, str):
+        inparams = []
+        for param in cmdline.split(' '):
+            for subparam in param.split("="):
+                inparams.append(subparam)
+    else:
+        inparams = list(cmdline)
+    for parameter in ('--queue', '-q', '--batch-opts'):
+        ## If a parameter is in the list, remove it and its argument
+        ## Else if it is a '--' command, it might be --option=value, which won't be split.
+        ##      check for that and remove the whole "--option=value"
+        try:
+            loc = inparams.index(parameter)
+            del inparams[loc:loc+2]
+        except ValueError:
+            if parameter.startswith('--'):
+                prefix = parameter + '='
+                inparams = [p for p in inparams if not p.startswith(prefix)]
+
+    cmd = ' '.join(inparams)
+    cmd = cmd.replace(' --batch', ' ').replace(' --nosubmit', ' ')
+    cmd += f' --timingfile {timingfile}'
+
+    if '--mpi' not in cmd:
+        cmd += ' --mpi'
+
+    #- fluxcalib steps use less MPI parallelism and more multiprocessing
+    ntasks = threads_per_task = None
+    if jobdesc.lower() in ['science', 'stdstarfit', 'poststdstar']:
+        if nodes*4 > ncameras:
+            #- only one rank per camera; multiprocessing fans out the rest
+            ntasks = ncameras
         else:
-            if jobdesc.lower() in ['science','prestdstar']:
-                fx.write('\n# Do steps through skysub at full MPI parallelism\n')
-                srun = f'srun -N {nodes} -n {ncores} -c {threads_per_core} --cpu-bind=cores {cmd} --nofluxcalib'
-                fx.write('echo Running {}\n'.format(srun))
-                fx.write('{}\n'.format(srun))
-            if jobdesc.lower() in ['science', 'stdstarfit', 'poststdstar']:
-                if nodes*4 > ncameras:
-                    #- only one rank per camera; multiprocessing fans out the rest
-                    ntasks = ncameras
-                else:
-                    #- but don't run more than 4 per node (to be tuned)
-                    ntasks = nodes*4
-
-                tot_threads = nodes * batch_config['cores_per_node'] * batch_config['threads_per_core']
-                threads_per_task = max(int(tot_threads / ntasks), 1)
-                fx.write('\n# Use less MPI parallelism for fluxcalib MP parallelism\n')
-                fx.write('# This should quickly skip over the steps already done\n')
-                #- fluxcalib multiprocessing parallelism needs --cpu-bind=none (or at least not "cores")
-                srun = f'srun -N {nodes} -n {ntasks} -c {threads_per_task} --cpu-bind=none {cmd} '
-                fx.write('if [ $? -eq 0 ]; then\n')
-                fx.write('  echo Running {}\n'.format(srun))
-                fx.write('  {}\n'.format(srun))
-                fx.write('else\n')
-                fx.write('  echo FAILED: done at $(date)\n')
-                fx.write('  exit 1\n')
-                fx.write('fi\n')
-
-        fx.write('\nif [ $? -eq 0 ]; then\n')
-        fx.write('  echo SUCCESS: done at $(date)\n')
-        fx.write('else\n')
-        fx.write('  echo FAILED: done at $(date)\n')
-        fx.write('  exit 1\n')
-        fx.write('fi\n')
+            #- but don't run more than 4 per node (to be tuned)
+            ntasks = nodes*4
+
+        tot_threads = nodes * threads_per_node
+        threads_per_task = max(int(tot_threads / ntasks), 1)
+
+    if batch_opts is not None:
+        batch_opts = f'#SBATCH {batch_opts}\n'
+    else:
+        batch_opts = ''
+
+    template = _batch_script_template(jobdesc.lower(), system_name, nightlybias)
+    script = template.substitute(jobdesc=jobdesc, nodes=nodes, queue=queue, batch_opts=batch_opts,
+                                 jobname=jobname, batchdir=batchdir,
+                                 runtime=f'{runtime_hh:02d}:{runtime_mm:02d}:00',
+                                 ncameras=ncameras, ncores=ncores, threads_per_core=threads_per_core,
+                                 ntasks=ntasks, threads_per_task=threads_per_task, cmd=cmd)
+
+    with open(scriptfile, 'w') as fx:
+        fx.write(script)
 
     print('Wrote {}'.format(scriptfile))
     print('logfile will be {}/{}-JOBID.log\n'.format(batchdir, jobname))
@@ -628,17 +717,33 @@ def find_most_recent(night, file_type='psfnight', cam='r', n_nights=30):
                      If none found, None is returned.
 
     '''
-    # Set the time as Noon on the day in question
-    today = time.strptime('{} 12'.format(night),'%Y%m%d %H')
-    one_day = 60*60*24 # seconds
+    night = str(night)
 
-    test_night_struct = today
+    today = datetime.datetime.strptime(night, '%Y%m%d').date()
 
     # Search a month in the past
-    for daysback in range(n_nights) :
-        test_night_struct = time.strptime(time.ctime(time.mktime(test_night_struct)-one_day))
-        test_night_str = time.strftime('%Y%m%d', test_night_struct)
-        nightfile = findfile(file_type, test_night_str, camera=cam)
+    test_nights = list()
+    for daysback in range(1, n_nights+1):
+        test_night = today - datetime.timedelta(days=daysback)
+        test_nights.append(test_night.strftime('%Y%m%d'))
+
+    #- Nightly calibrations live in one directory per night, so list the parent
+    #- directory once and only look for files in nights that have a directory.
+    #- The candidate filenames follow from the one for the requested night.
+    nightdir, filename = os.path.split(findfile(file_type, night, camera=cam))
+    if os.path.basename(nightdir) == night:
+        calibdir = os.path.dirname(nightdir)
+        try:
+            with os.scandir(calibdir) as entries:
+                available = {entry.name for entry in entries}
+        except FileNotFoundError:
+            return None
+        nightfiles = [os.path.join(calibdir, n, filename.replace(night, n))
+                      for n in test_nights if n in available]
+    else:
+        nightfiles = [findfile(file_type, n, camera=cam) for n in test_nights]
+
+    for nightfile in nightfiles:
         if os.path.isfile(nightfile) :
             return nightfile
 